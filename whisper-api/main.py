@@ -1,25 +1,568 @@
 import os
-import subprocess
+import re
+import json
+import errno
+import mmap
+import shutil
+import time
+import bisect
+import asyncio
+import functools
 import uuid
-import hashlib
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import BinaryIO
+import numpy as np
+import ctranslate2
+from blake3 import blake3
+from faster_whisper import BatchedInferencePipeline, WhisperModel
+from fastapi import FastAPI, UploadFile, File, Header, Query, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 
 # --- Configuration ---
 # Adjust these paths based on your file structure
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-WHISPER_CPP_PATH = os.path.join(BASE_DIR, "whisper.cpp")
-WHISPER_MODEL_PATH = os.path.join(WHISPER_CPP_PATH, "models", "ggml-base.en.bin")
-WHISPER_EXECUTABLE = os.path.join(WHISPER_CPP_PATH, "build", "bin", "whisper-cli")
+# faster-whisper (CTranslate2) model, runs on CUDA when available and falls back to CPU
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "base.en")
+WHISPER_DEVICE = os.getenv("WHISPER_DEVICE", "auto")
+# Defaults to float16 on CUDA and int8 on CPU, the fastest option on each
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE")
 TEMP_DIR = os.path.join(BASE_DIR, "temp")
 CACHE_DIR = os.path.join(BASE_DIR, "cache")
+# Per-chunk transcriptions, shared between uploads that contain the same audio
+CHUNK_CACHE_DIR = os.path.join(CACHE_DIR, "chunks")
+# Whisper expects 16kHz mono 16-bit PCM
+AUDIO_SAMPLE_RATE = 16000
+AUDIO_CHANNELS = 1
+# Decoding and resampling are cheap next to inference, a couple of threads is plenty
+FFMPEG_THREADS = max(1, int(os.getenv("FFMPEG_THREADS", "2")))
+# Pinning goes through taskset so the CPU mask is set before exec, runs are unpinned without it
+TASKSET_PATH = shutil.which("taskset")
+# Only the end of a tool's stderr is kept, that's where the error is
+STDERR_TAIL_BYTES = 4096
+# Stage timeouts scale with the audio duration, with a floor for short or unprobeable inputs
+FFMPEG_TIMEOUT_MIN = float(os.getenv("FFMPEG_TIMEOUT_MIN", "30"))
+FFMPEG_TIMEOUT_PER_SECOND = float(os.getenv("FFMPEG_TIMEOUT_PER_SECOND", "0.2"))
+WHISPER_TIMEOUT_MIN = float(os.getenv("WHISPER_TIMEOUT_MIN", "60"))
+WHISPER_TIMEOUT_PER_SECOND = float(os.getenv("WHISPER_TIMEOUT_PER_SECOND", "2"))
+# Uploads are copied to disk in blocks of this size
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Prefix for cache keys, keeps BLAKE3 entries apart from legacy SHA-256 ones
+HASH_ALGO = "b3"
+# A hex-encoded 256-bit BLAKE3 digest, as sent in the X-Content-BLAKE3 header
+HASH_HEX_PATTERN = re.compile(r"[0-9a-f]{64}")
+# Number of inference requests allowed in flight at once, each gets a fair share of the CPUs
+WHISPER_CONCURRENCY = max(1, int(os.getenv("WHISPER_CONCURRENCY", "1")))
+# CPUs this process may run on. Once inference can keep three quarters of them, ffmpeg gets
+# FFMPEG_THREADS of its own and inference the rest, so neither evicts the other from cache;
+# smaller machines leave both unpinned
+if hasattr(os, "sched_getaffinity"):
+    AVAILABLE_CPUS = tuple(sorted(os.sched_getaffinity(0)))
+else:
+    AVAILABLE_CPUS = tuple(range(os.cpu_count() or 1))
+FFMPEG_CPUS = AVAILABLE_CPUS[-FFMPEG_THREADS:] if len(AVAILABLE_CPUS) >= 4 * FFMPEG_THREADS else ()
+WHISPER_CPUS = AVAILABLE_CPUS[:-len(FFMPEG_CPUS)] if FFMPEG_CPUS else ()
+WHISPER_THREADS = max(1, len(WHISPER_CPUS or AVAILABLE_CPUS) // WHISPER_CONCURRENCY)
+# Uncached chunks of an upload are decoded together, this many per batched model call
+WHISPER_BATCH_SIZE = max(1, int(os.getenv("WHISPER_BATCH_SIZE", "8")))
+# Hashes with a cached transcription, loaded from CACHE_DIR at startup so hits skip the stat call
+CACHED_HASHES: set[str] = set()
+# Hot cached transcriptions are kept in memory, files above the threshold are read via mmap
+CAPTION_CACHE_SIZE = int(os.getenv("CAPTION_CACHE_SIZE", "1024"))
+CAPTION_MMAP_THRESHOLD = 64 * 1024
+# Chunk hashes with a cached transcription, loaded from CHUNK_CACHE_DIR at startup
+CACHED_CHUNKS: set[str] = set()
+# Audio is cut at pauses into chunks between the min and max length, max matches whisper's 30s window
+CHUNK_MIN_SECONDS = float(os.getenv("CHUNK_MIN_SECONDS", "10"))
+CHUNK_MAX_SECONDS = float(os.getenv("CHUNK_MAX_SECONDS", "30"))
+# Silence is measured over a sliding 100ms window, a pause is at least 300ms quieter than about -40 dBFS
+CHUNK_FRAME_SAMPLES = AUDIO_SAMPLE_RATE // 10
+CHUNK_SILENCE_RMS = 0.01
+CHUNK_SILENCE_MIN_FRAMES = 3
+# Window energies are computed this many windows at a time, keeping memory flat for long uploads
+CHUNK_ENERGY_BLOCK = 1 << 18
+# Size cap for everything under CACHE_DIR, 0 leaves the cache unbounded
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", "0"))
 
-def get_file_hash(file_content: bytes) -> str:
-    """Generate a hash from file content for caching"""
-    return hashlib.sha256(file_content).hexdigest()
+class CacheLRU:
+    """Size-capped least-recently-used index of the files under CACHE_DIR
+
+    WAVs are evicted before any transcription: they are large and can be
+    regenerated from the next upload, while transcriptions are tiny.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.audio: OrderedDict[str, int] = OrderedDict()
+        self.text: OrderedDict[str, int] = OrderedDict()
+
+    def _entries_for(self, path: str) -> OrderedDict[str, int]:
+        return self.audio if path.endswith('.wav') else self.text
+
+    def load(self, *cache_dirs: str):
+        """Index existing cache files, oldest access first"""
+        found = []
+        for cache_dir in cache_dirs:
+            with os.scandir(cache_dir) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.endswith(('.wav', '.txt')):
+                        stat = entry.stat()
+                        found.append((max(stat.st_atime, stat.st_mtime), entry.path, stat.st_size))
+        for _, path, size in sorted(found):
+            self.add(path, size)
+
+    def add(self, path: str, size: int):
+        """Record a newly written cache file"""
+        entries = self._entries_for(path)
+        self.total_bytes += size - entries.pop(path, 0)
+        entries[path] = size
+
+    def touch(self, path: str):
+        """Mark a cache file as just used"""
+        entries = self._entries_for(path)
+        if path in entries:
+            entries.move_to_end(path)
+
+    def evict(self) -> list[str]:
+        """Drop entries until the cache fits its cap, returns the paths to delete"""
+        evicted = []
+        while self.max_bytes and self.total_bytes > self.max_bytes and (self.audio or self.text):
+            path, size = (self.audio or self.text).popitem(last=False)
+            self.total_bytes -= size
+            evicted.append(path)
+        return evicted
+
+CACHE_LRU = CacheLRU(CACHE_MAX_BYTES)
+# Uploads currently being transcribed, identical uploads wait on these instead of redoing the work
+INFLIGHT: dict[str, asyncio.Future] = {}
+
+def save_upload(file: UploadFile, dest_path: str) -> int:
+    """Copy a spooled upload to disk in one pass, returns the number of bytes written"""
+    file.file.seek(0)
+    with open(dest_path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer, length=UPLOAD_CHUNK_SIZE)
+        return buffer.tell()
+
+def write_text_file(file_path: str, text: str):
+    """Write a text file, meant to be run via asyncio.to_thread"""
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+def link_or_copy(src_path: str, dest_path: str):
+    """Hardlink a file, falling back to a copy when the paths are on different filesystems"""
+    try:
+        os.link(src_path, dest_path)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    # shutil.copyfile copies in-kernel on Linux, going through a .part keeps the destination all-or-nothing
+    partial_path = f"{dest_path}.{uuid.uuid4()}.part"
+    try:
+        shutil.copyfile(src_path, partial_path)
+        os.replace(partial_path, dest_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+def get_file_hash(file_path: str) -> str:
+    """Generate a cache key from file content using multi-threaded mmap'd BLAKE3"""
+    hasher = blake3(max_threads=blake3.AUTO)
+    hasher.update_mmap(file_path)
+    return f"{HASH_ALGO}_{hasher.hexdigest()}"
+
+async def read_tail(stream: asyncio.StreamReader, limit: int) -> bytes:
+    """Drain a stream, keeping only its last `limit` bytes"""
+    tail = bytearray()
+    while chunk := await stream.read(64 * 1024):
+        tail += chunk
+        if len(tail) > limit:
+            del tail[:-limit]
+    return bytes(tail)
+
+@contextmanager
+def pinned_to(cpus: tuple[int, ...]):
+    """Restrict the calling thread to the given CPUs for the duration of the block, a no-op without any"""
+    if not cpus or not hasattr(os, "sched_setaffinity"):
+        yield
+        return
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, previous)
+
+async def run_process(
+    *cmd: str, cwd: str | None = None, timeout: float | None = None, cpus: tuple[int, ...] = ()
+) -> tuple[int, bytes, bytes]:
+    """Run a command, returns its exit code, full stdout and the tail of its stderr
+
+    The process is killed if it runs past the timeout or the request is cancelled.
+    When CPUs are given the command is launched under taskset, pinned from its first instruction.
+    """
+    exec_cmd = cmd
+    if cpus and TASKSET_PATH:
+        exec_cmd = (TASKSET_PATH, '-c', ','.join(map(str, cpus)), *cmd)
+    proc = await asyncio.create_subprocess_exec(
+        *exec_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, cwd=cwd
+    )
+    try:
+        stdout, stderr_tail = await asyncio.wait_for(
+            asyncio.gather(proc.stdout.read(), read_tail(proc.stderr, STDERR_TAIL_BYTES)), timeout
+        )
+        return await proc.wait(), stdout, stderr_tail
+    except asyncio.TimeoutError:
+        print(f"{cmd[0]} timed out after {timeout:.0f}s")
+        raise HTTPException(status_code=504, detail=f"{cmd[0]} timed out after {timeout:.0f}s")
+    finally:
+        # Only reached with the child still running on timeout or cancellation
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+
+async def probe_audio(file_path: str) -> dict:
+    """Return the first audio stream and container info from ffprobe, empty if probing fails"""
+    returncode, stdout, _ = await run_process(
+        'ffprobe', '-v', 'error', '-select_streams', 'a:0',
+        '-show_entries', 'stream=codec_name,sample_rate,channels:format=format_name,duration',
+        '-of', 'json', file_path,
+        timeout=FFMPEG_TIMEOUT_MIN, cpus=FFMPEG_CPUS
+    )
+    if returncode != 0:
+        return {}
+    try:
+        return json.loads(stdout)
+    except ValueError:
+        return {}
+
+def is_whisper_ready_wav(probe: dict) -> bool:
+    """Check whether a probed file is already a 16kHz mono s16le WAV"""
+    streams = probe.get("streams") or [{}]
+    stream = streams[0]
+    return (
+        probe.get("format", {}).get("format_name") == "wav"
+        and stream.get("codec_name") == "pcm_s16le"
+        and stream.get("sample_rate") == str(AUDIO_SAMPLE_RATE)
+        and stream.get("channels") == AUDIO_CHANNELS
+    )
+
+def probe_duration(probe: dict) -> float:
+    """Container duration in seconds from an ffprobe result, 0 when unknown"""
+    try:
+        return float(probe.get("format", {}).get("duration", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+def pcm_to_array(pcm: bytes) -> np.ndarray:
+    """Convert raw s16le PCM to the float32 samples faster-whisper expects"""
+    return np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+
+def read_wav_samples(f: BinaryIO) -> np.ndarray:
+    """Read the samples of a 16kHz mono s16le WAV straight from its data chunk
+
+    Only used on WAVs that ffmpeg wrote or ffprobe checked, so the format chunk
+    is not parsed again.
+    """
+    header = f.read(12)
+    if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        raise ValueError("Not a WAV file")
+    while len(chunk_header := f.read(8)) == 8:
+        chunk_id, size = chunk_header[:4], int.from_bytes(chunk_header[4:], 'little')
+        if chunk_id == b'data':
+            # A WAV written to a pipe leaves the size unset, its data runs to the end of the file
+            pcm = f.read() if size in (0, 0xFFFFFFFF) else f.read(size)
+            return pcm_to_array(pcm[:len(pcm) // 2 * 2])
+        # Chunks are padded to an even size
+        f.seek(size + (size & 1), os.SEEK_CUR)
+    raise ValueError("WAV file has no data chunk")
+
+def load_wav_samples(file_path: str) -> np.ndarray:
+    """Read the samples of a 16kHz mono s16le WAV file"""
+    with open(file_path, 'rb') as f:
+        return read_wav_samples(f)
+
+def scan_cached_hashes(cache_dir: str) -> set[str]:
+    """Collect the hashes of all transcriptions stored in a cache directory"""
+    with os.scandir(cache_dir) as entries:
+        return {entry.name.removesuffix('.txt') for entry in entries if entry.name.endswith('.txt')}
+
+@functools.lru_cache(maxsize=CAPTION_CACHE_SIZE)
+def load_cached_caption(cache_path: str) -> str:
+    """Read a cached transcription once, later hits are served from memory
+
+    Entries are content addressed and only written while absent from their index,
+    so a memoized caption can never be stale.
+    """
+    with open(cache_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= CAPTION_MMAP_THRESHOLD:
+            return f.read().decode('utf-8').strip()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            return str(view, 'utf-8').strip()
+
+async def read_cached_caption(index: set[str], cache_dir: str, key: str) -> str | None:
+    """Return the transcription cached under a key, or None if there is none"""
+    if key not in index:
+        return None
+    cache_path = os.path.join(cache_dir, f"{key}.txt")
+    CACHE_LRU.touch(cache_path)
+    try:
+        return await asyncio.to_thread(load_cached_caption, cache_path)
+    except FileNotFoundError:
+        # Removed behind our back, treat it as a miss
+        index.discard(key)
+        return None
+
+async def get_cached_caption(file_hash: str) -> str | None:
+    """Return the cached transcription for a whole upload"""
+    return await read_cached_caption(CACHED_HASHES, CACHE_DIR, file_hash)
+
+def remove_files(file_paths: list[str]):
+    """Delete files, ignoring ones that are already gone"""
+    for file_path in file_paths:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+async def record_cache_write(cache_path: str):
+    """Account for a new cache file and evict least recently used files if over the cap"""
+    CACHE_LRU.add(cache_path, await asyncio.to_thread(os.path.getsize, cache_path))
+    evicted = CACHE_LRU.evict()
+    if not evicted:
+        return
+    for path in evicted:
+        if path.endswith('.txt'):
+            index = CACHED_CHUNKS if os.path.dirname(path) == CHUNK_CACHE_DIR else CACHED_HASHES
+            index.discard(os.path.basename(path).removesuffix('.txt'))
+    await asyncio.to_thread(remove_files, evicted)
+    print(f"Evicted {len(evicted)} cache files, cache now {CACHE_LRU.total_bytes} bytes")
+
+def window_energies(audio: np.ndarray, start: int, stop: int) -> np.ndarray:
+    """Energy of each window starting in [start, stop), in integer PCM units
+
+    The sums are exact, so they don't depend on where the range begins.
+    """
+    pcm = np.round(audio[start:stop + CHUNK_FRAME_SAMPLES - 1] * 32768).astype(np.int64)
+    energy_sums = np.concatenate(([0], np.cumsum(pcm * pcm)))
+    return energy_sums[CHUNK_FRAME_SAMPLES:] - energy_sums[:-CHUNK_FRAME_SAMPLES]
+
+def find_pauses(audio: np.ndarray) -> list[int]:
+    """Return the middle sample of every long enough pause, scanning the audio block by block"""
+    window = CHUNK_FRAME_SAMPLES
+    window_count = len(audio) - window + 1
+    threshold = (CHUNK_SILENCE_RMS * 32768) ** 2 * window
+    pauses = []
+
+    def close_run(start: int, end: int):
+        # A run of n silent windows covers n + window - 1 quiet samples
+        quiet_samples = end - start + window - 1
+        if quiet_samples >= CHUNK_SILENCE_MIN_FRAMES * window:
+            pauses.append(start + quiet_samples // 2)
+
+    was_silent = False
+    run_start = None
+    for block_start in range(0, window_count, CHUNK_ENERGY_BLOCK):
+        block_stop = min(block_start + CHUNK_ENERGY_BLOCK, window_count)
+        silent = window_energies(audio, block_start, block_stop) < threshold
+        # Windows where silence starts or ends, runs carry over across block boundaries
+        changes = np.flatnonzero(np.diff(np.concatenate(([was_silent], silent)))) + block_start
+        for change in changes.tolist():
+            if run_start is None:
+                run_start = change
+            else:
+                close_run(run_start, change)
+                run_start = None
+        was_silent = bool(silent[-1])
+    if run_start is not None:
+        close_run(run_start, window_count)
+    return pauses
+
+def split_on_silence(audio: np.ndarray) -> list[np.ndarray]:
+    """Cut audio into content-defined chunks at pauses
+
+    Cuts are placed at sample-exact positions found from the audio itself, not
+    on a grid anchored at the start of the file, so an edit early in a file
+    leaves the later chunks, and their cache keys, unchanged.
+    """
+    min_samples = int(CHUNK_MIN_SECONDS * AUDIO_SAMPLE_RATE)
+    max_samples = int(CHUNK_MAX_SECONDS * AUDIO_SAMPLE_RATE)
+    window = CHUNK_FRAME_SAMPLES
+    if len(audio) <= max_samples or len(audio) < window:
+        return [audio] if len(audio) else []
+
+    chunks = []
+    start = 0
+    for cut in [*find_pauses(audio), len(audio)]:
+        while cut - start > max_samples:
+            # No pause in range, fall back to the middle of the quietest window between min and max length
+            lo = start + min_samples
+            hi = min(start + max_samples - window // 2, len(audio) - window + 1)
+            forced = lo + int(np.argmin(window_energies(audio, lo, hi))) + window // 2 if hi > lo else start + max_samples
+            chunks.append(audio[start:forced])
+            start = forced
+        if cut - start >= min_samples or cut == len(audio):
+            chunks.append(audio[start:cut])
+            start = cut
+    return [chunk for chunk in chunks if len(chunk)]
+
+def hash_chunks(chunks: list[np.ndarray]) -> list[str]:
+    """Generate a cache key for each audio chunk from its samples"""
+    return [f"{HASH_ALGO}_{blake3(chunk.view(np.uint8)).hexdigest()}" for chunk in chunks]
+
+def resolve_whisper_device() -> str:
+    """Pick the inference device, preferring CUDA when CTranslate2 can see a GPU"""
+    if WHISPER_DEVICE != "auto":
+        return WHISPER_DEVICE
+    return "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+
+def get_compute_type(device: str) -> str:
+    """Return the configured compute type, or the fastest default for the device"""
+    return WHISPER_COMPUTE_TYPE or ("float16" if device == "cuda" else "int8")
+
+def get_whisper_workers(device: str) -> int:
+    """A GPU runs one request at a time better than several, CPUs split into WHISPER_CONCURRENCY workers"""
+    return 1 if device == "cuda" else WHISPER_CONCURRENCY
+
+def load_whisper_model(device: str) -> WhisperModel:
+    """Load the whisper model once, one CTranslate2 worker per whisper worker task"""
+    compute_type = get_compute_type(device)
+    print(f"Loading whisper model {WHISPER_MODEL} on {device} ({compute_type}) with {WHISPER_THREADS} threads per worker")
+    # CTranslate2's threads inherit the CPU mask of the thread that creates them
+    with pinned_to(WHISPER_CPUS):
+        return WhisperModel(
+            WHISPER_MODEL, device=device, compute_type=compute_type,
+            cpu_threads=WHISPER_THREADS, num_workers=get_whisper_workers(device)
+        )
+
+def transcribe_job(
+    pipeline: BatchedInferencePipeline, audio: np.ndarray, clips: list[tuple[int, int]], deadline: float
+) -> list[str]:
+    """Transcribe clips of one audio in batches, meant to be run via asyncio.to_thread
+
+    Returns one transcription per (start, end) sample range. The time.monotonic()
+    deadline is checked between segments so a stuck job gives the thread back to
+    the next one in the queue.
+    """
+    try:
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        # Chunks already fit whisper's 30s window, each clip is one entry of a batch
+        # Greedy decoding is plenty for short clips
+        clip_starts = [start / AUDIO_SAMPLE_RATE for start, _ in clips]
+        texts = [[] for _ in clips]
+        # Feature extraction runs on this thread, keep it on inference's CPUs too
+        with pinned_to(WHISPER_CPUS):
+            segments, _ = pipeline.transcribe(
+                audio,
+                clip_timestamps=[{"start": start / AUDIO_SAMPLE_RATE, "end": end / AUDIO_SAMPLE_RATE} for start, end in clips],
+                batch_size=WHISPER_BATCH_SIZE, beam_size=1
+            )
+            for segment in segments:
+                # Segment times are absolute, the midpoint falls inside the clip it came from
+                index = bisect.bisect_right(clip_starts, (segment.start + segment.end) / 2) - 1
+                texts[max(index, 0)].append(segment.text.strip())
+                if time.monotonic() > deadline:
+                    raise TimeoutError
+        return [" ".join(clip_texts).strip() for clip_texts in texts]
+    except TimeoutError:
+        print("Transcription timed out")
+        raise HTTPException(status_code=504, detail="Transcription timed out")
+    except Exception as e:
+        print(f"Whisper error: {e}")
+        raise HTTPException(status_code=500, detail=f"Transcription failed: {e}")
+
+async def whisper_worker(queue: asyncio.Queue, pipeline: BatchedInferencePipeline):
+    """Run queued transcriptions one at a time and resolve their futures
+
+    A job's timeout starts when a worker picks it up, time spent queued behind
+    other uploads is not held against it.
+    """
+    while True:
+        audio, clips, timeout, future = await queue.get()
+        if future.cancelled():
+            continue
+        deadline = time.monotonic() + timeout
+        try:
+            result = await asyncio.to_thread(transcribe_job, pipeline, audio, clips, deadline)
+        except HTTPException as e:
+            if not future.cancelled():
+                future.set_exception(e)
+            continue
+        if not future.cancelled():
+            future.set_result(result)
+
+async def transcribe_clips(audio: np.ndarray, clips: list[tuple[int, int]], timeout: float) -> list[str]:
+    """Queue clips of audio for the next free whisper worker and wait for their transcriptions"""
+    future = asyncio.get_running_loop().create_future()
+    await app.state.whisper_queue.put((audio, clips, timeout, future))
+    return await future
+
+async def transcribe_chunks(audio: np.ndarray, cache: bool) -> str:
+    """Transcribe audio chunk by chunk, reusing cached chunks and batching the rest"""
+    chunks = await asyncio.to_thread(split_on_silence, audio)
+    chunk_hashes = await asyncio.to_thread(hash_chunks, chunks)
+    captions = [await read_cached_caption(CACHED_CHUNKS, CHUNK_CACHE_DIR, chunk_hash) for chunk_hash in chunk_hashes]
+    missing = [i for i, caption in enumerate(captions) if caption is None]
+    print(f"Split audio into {len(chunks)} chunks, {len(chunks) - len(missing)} cached")
+
+    # All misses go to the model as clips of one batched call
+    offsets = np.cumsum([0, *map(len, chunks)])
+    clips = [(int(offsets[i]), int(offsets[i + 1])) for i in missing]
+    timeout = max(WHISPER_TIMEOUT_MIN, WHISPER_TIMEOUT_PER_SECOND * len(audio) / AUDIO_SAMPLE_RATE)
+    results = await transcribe_clips(audio, clips, timeout) if clips else []
+    for i, caption in zip(missing, results):
+        captions[i] = caption
+        if cache:
+            chunk_path = os.path.join(CHUNK_CACHE_DIR, f"{chunk_hashes[i]}.txt")
+            try:
+                await asyncio.to_thread(write_text_file, chunk_path, caption)
+                CACHED_CHUNKS.add(chunk_hashes[i])
+                await record_cache_write(chunk_path)
+            except Exception as e:
+                print(f"Failed to save chunk transcription to cache: {e}")
+
+    return " ".join(caption for caption in captions if caption)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    CACHED_HASHES.update(scan_cached_hashes(CACHE_DIR))
+    CACHED_CHUNKS.update(scan_cached_hashes(CHUNK_CACHE_DIR))
+    print(f"Loaded {len(CACHED_HASHES)} cached transcriptions and {len(CACHED_CHUNKS)} cached chunks from: {CACHE_DIR}")
+    await asyncio.to_thread(CACHE_LRU.load, CACHE_DIR, CHUNK_CACHE_DIR)
+    print(f"Cache holds {CACHE_LRU.total_bytes} bytes (limit: {CACHE_MAX_BYTES or 'none'})")
+    device = resolve_whisper_device()
+    try:
+        model = await asyncio.to_thread(load_whisper_model, device)
+    except Exception as e:
+        if device != "cuda" or WHISPER_DEVICE != "auto":
+            raise
+        print(f"Failed to load whisper model on CUDA, falling back to CPU: {e}")
+        device = "cpu"
+        model = await asyncio.to_thread(load_whisper_model, device)
+    app.state.model = model
+    app.state.pipeline = BatchedInferencePipeline(model)
+    app.state.whisper_device = device
+    app.state.whisper_queue = asyncio.Queue()
+    if FFMPEG_CPUS:
+        print(f"ffmpeg reserved CPUs {list(FFMPEG_CPUS)}{'' if TASKSET_PATH else ' (unpinned, no taskset)'}, inference runs on the other {len(WHISPER_CPUS)}")
+    workers = [
+        asyncio.create_task(whisper_worker(app.state.whisper_queue, app.state.pipeline))
+        for _ in range(get_whisper_workers(device))
+    ]
+    try:
+        yield
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
 
 # --- FastAPI App ---
-app = FastAPI(title="Whisper.cpp Transcription API", version="1.0.0")
+app = FastAPI(title="Whisper Transcription API", version="1.0.0", lifespan=lifespan)
 
 # Add CORS middleware to allow requests from the Hono server
 app.add_middleware(
@@ -33,103 +576,146 @@ app.add_middleware(
 # Create temp and cache directories if they don't exist
 os.makedirs(TEMP_DIR, exist_ok=True)
 os.makedirs(CACHE_DIR, exist_ok=True)
+os.makedirs(CHUNK_CACHE_DIR, exist_ok=True)
 
 @app.post("/transcribe")
-async def transcribe_video(file: UploadFile = File(...)):
+async def transcribe_video(
+    file: UploadFile = File(...),
+    x_content_blake3: str | None = Header(None),
+    cache: bool = Query(True, description="Set to false to skip storing audio and transcription for one-off requests")
+):
     # Validate file
     if not file.filename:
         raise HTTPException(status_code=400, detail="No file provided")
-    
-    # Read file content for hashing and processing
-    file_content = await file.read()
-    file_hash = get_file_hash(file_content)
-    
-    # Log the incoming request
-    print(f"Received file: {file.filename}, Content-Type: {file.content_type}, Size: {len(file_content)}, Hash: {file_hash}")
-    
-    # Check if we have cached transcription
-    cached_transcription_path = os.path.join(CACHE_DIR, f"{file_hash}.txt")
-    if os.path.exists(cached_transcription_path):
-        print(f"Found cached transcription for hash: {file_hash}")
-        with open(cached_transcription_path, 'r', encoding='utf-8') as f:
-            cached_caption = f.read().strip()
-        return {"caption": cached_caption, "cached": True}
-    
-    if not os.path.exists(WHISPER_EXECUTABLE):
-        raise HTTPException(status_code=500, detail=f"Whisper executable not found at: {WHISPER_EXECUTABLE}")
-    if not os.path.exists(WHISPER_MODEL_PATH):
-        raise HTTPException(status_code=500, detail=f"Whisper model not found at: {WHISPER_MODEL_PATH}")
 
+    # A client-supplied digest lets cache hits skip reading the upload entirely
+    claimed_hash = None
+    if x_content_blake3 is not None:
+        claimed_digest = x_content_blake3.strip().lower()
+        if not HASH_HEX_PATTERN.fullmatch(claimed_digest):
+            raise HTTPException(status_code=400, detail="X-Content-BLAKE3 must be a 64 character hex digest")
+        claimed_hash = f"{HASH_ALGO}_{claimed_digest}"
+        cached_caption = await get_cached_caption(claimed_hash)
+        if cached_caption is not None:
+            print(f"Found cached transcription for client-supplied hash: {claimed_hash}")
+            return {"caption": cached_caption, "cached": True}
+    
     # Generate unique filenames to avoid conflicts
     unique_id = str(uuid.uuid4())
     temp_input_path = os.path.join(TEMP_DIR, f"{unique_id}_{file.filename}")
-    # Whisper requires a 16kHz WAV file
-    temp_audio_path = os.path.join(TEMP_DIR, f"{unique_id}.wav")
-    # Cached audio file path
-    cached_audio_path = os.path.join(CACHE_DIR, f"{file_hash}.wav")
+    # ffmpeg tees the cached WAV here first so a failed conversion never leaves a partial cache entry
+    partial_audio_path = None
+    inflight = None
 
     try:
-        # Check if we have cached audio file
-        if os.path.exists(cached_audio_path):
+        # 1. Stream the uploaded file to disk (could be video or audio) and hash it there
+        print(f"Saving uploaded file to: {temp_input_path}")
+        file_size = await asyncio.to_thread(save_upload, file, temp_input_path)
+        file_hash = await asyncio.to_thread(get_file_hash, temp_input_path)
+
+        # Log the incoming request
+        print(f"Received file: {file.filename}, Content-Type: {file.content_type}, Size: {file_size}, Hash: {file_hash}")
+
+        if claimed_hash is not None and claimed_hash != file_hash:
+            raise HTTPException(status_code=400, detail=f"X-Content-BLAKE3 does not match the uploaded file (computed {file_hash})")
+
+        # Check if we have cached transcription
+        cached_transcription_path = os.path.join(CACHE_DIR, f"{file_hash}.txt")
+        cached_caption = await get_cached_caption(file_hash)
+        if cached_caption is not None:
+            print(f"Found cached transcription for hash: {file_hash}")
+            return {"caption": cached_caption, "cached": True}
+
+        # Coalesce with an identical upload that is already being transcribed
+        if file_hash in INFLIGHT:
+            print(f"Waiting for in-flight transcription of hash: {file_hash}")
+            return {"caption": await asyncio.shield(INFLIGHT[file_hash]), "cached": False, "coalesced": True}
+        inflight = asyncio.get_running_loop().create_future()
+        INFLIGHT[file_hash] = inflight
+
+        # Cached audio file path
+        cached_audio_path = os.path.join(CACHE_DIR, f"{file_hash}.wav")
+
+        # Check if we have cached audio file, a missing or just evicted one is a miss
+        # Once open, eviction can unlink it without cutting the read short
+        try:
+            cached_audio = await asyncio.to_thread(open, cached_audio_path, 'rb')
+        except FileNotFoundError:
+            cached_audio = None
+
+        if cached_audio is not None:
             print(f"Found cached audio file for hash: {file_hash}")
-            temp_audio_path = cached_audio_path
+            CACHE_LRU.touch(cached_audio_path)
+            with cached_audio:
+                audio = await asyncio.to_thread(read_wav_samples, cached_audio)
+        elif is_whisper_ready_wav(probe := await probe_audio(temp_input_path)):
+            # 2. The upload is already a 16kHz mono WAV, no conversion needed
+            print("Upload is already 16kHz mono PCM, skipping conversion")
+            if cache:
+                try:
+                    await asyncio.to_thread(link_or_copy, temp_input_path, cached_audio_path)
+                    await record_cache_write(cached_audio_path)
+                except FileExistsError:
+                    pass
+            audio = await asyncio.to_thread(load_wav_samples, temp_input_path)
         else:
-            # 1. Save the uploaded file temporarily (could be video or audio)
-            print(f"Saving uploaded file to: {temp_input_path}")
-            with open(temp_input_path, "wb") as buffer:
-                buffer.write(file_content)
-
-            # 2. Use FFmpeg to extract/convert audio to 16kHz mono WAV
+            # 2. Use FFmpeg to extract/convert audio to 16kHz mono PCM on a pipe
             # This handles both video files (extracts audio) and audio files (converts format)
-            print(f"Converting audio to WAV format: {cached_audio_path}")
-            ffmpeg_result = subprocess.run([
-                'ffmpeg', '-y', '-i', temp_input_path, '-ar', '16000', '-ac', '1', '-c:a', 'pcm_s16le', cached_audio_path
-            ], capture_output=True, text=True)
-            
-            if ffmpeg_result.returncode != 0:
-                print(f"FFmpeg error: {ffmpeg_result.stderr}")
-                raise HTTPException(status_code=500, detail=f"Audio conversion failed: {ffmpeg_result.stderr}")
-            
-            temp_audio_path = cached_audio_path
+            # When caching, the tee muxer writes the WAV to disk in the same pass
+            # Video, subtitle and data streams are never demuxed
+            ffmpeg_cmd = [
+                'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+                '-vn', '-sn', '-dn', '-i', temp_input_path, '-map', '0:a:0',
+                '-ar', str(AUDIO_SAMPLE_RATE), '-ac', str(AUDIO_CHANNELS), '-c:a', 'pcm_s16le',
+                '-threads', str(FFMPEG_THREADS)
+            ]
+            if cache:
+                partial_audio_name = f"{file_hash}.{unique_id}.wav.part"
+                partial_audio_path = os.path.join(CACHE_DIR, partial_audio_name)
+                ffmpeg_cmd += ['-f', 'tee', f"[f=wav]{partial_audio_name}|[f=s16le]pipe:1"]
+            else:
+                ffmpeg_cmd += ['-f', 's16le', 'pipe:1']
 
-        # 3. Run the Whisper.cpp command
-        print(f"Running whisper-cli on: {temp_audio_path}")
-        whisper_result = subprocess.run([
-            WHISPER_EXECUTABLE, '-m', WHISPER_MODEL_PATH, '-f', temp_audio_path, '--output-txt', '--no-prints'
-        ], capture_output=True, text=True, cwd=TEMP_DIR)
-        
-        if whisper_result.returncode != 0:
-            print(f"Whisper error: {whisper_result.stderr}")
-            raise HTTPException(status_code=500, detail=f"Transcription failed: {whisper_result.stderr}")
+            print(f"Converting audio to PCM{' and caching WAV at: ' + cached_audio_path if cache else ''}")
+            ffmpeg_timeout = max(FFMPEG_TIMEOUT_MIN, FFMPEG_TIMEOUT_PER_SECOND * probe_duration(probe))
+            ffmpeg_returncode, pcm_audio, ffmpeg_stderr = await run_process(
+                *ffmpeg_cmd, cwd=CACHE_DIR, timeout=ffmpeg_timeout, cpus=FFMPEG_CPUS
+            )
 
-        # 4. Read the transcription from the generated text file
-        transcription_path = f"{temp_audio_path}.txt"
-        print(f"Reading transcription from: {transcription_path}")
-        
-        if not os.path.exists(transcription_path):
-            raise HTTPException(status_code=500, detail="Transcription file was not generated")
-            
-        with open(transcription_path, 'r', encoding='utf-8') as f:
-            caption = f.read().strip()
+            if ffmpeg_returncode != 0:
+                ffmpeg_error = ffmpeg_stderr.decode('utf-8', errors='replace')
+                print(f"FFmpeg error: {ffmpeg_error}")
+                raise HTTPException(status_code=500, detail=f"Audio conversion failed: {ffmpeg_error}")
+
+            if partial_audio_path is not None:
+                await asyncio.to_thread(os.replace, partial_audio_path, cached_audio_path)
+                partial_audio_path = None
+                await record_cache_write(cached_audio_path)
+
+            audio = pcm_to_array(pcm_audio)
+
+        # 3. Transcribe the audio chunks that are not cached yet with the resident whisper model
+        caption = await transcribe_chunks(audio, cache)
 
         if not caption:
             caption = "[No speech detected]"
         
         # 5. Save transcription to cache
-        try:
-            with open(cached_transcription_path, 'w', encoding='utf-8') as f:
-                f.write(caption)
-            print(f"Saved transcription to cache: {cached_transcription_path}")
-        except Exception as e:
-            print(f"Failed to save transcription to cache: {e}")
+        if cache:
+            try:
+                await asyncio.to_thread(write_text_file, cached_transcription_path, caption)
+                CACHED_HASHES.add(file_hash)
+                await record_cache_write(cached_transcription_path)
+                print(f"Saved transcription to cache: {cached_transcription_path}")
+            except Exception as e:
+                print(f"Failed to save transcription to cache: {e}")
             
         print(f"Transcription completed successfully: {len(caption)} characters")
+        inflight.set_result(caption)
         return {"caption": caption, "cached": False}
 
-    except subprocess.CalledProcessError as e:
-        error_msg = f"Subprocess failed: {e.stderr.decode() if e.stderr else str(e)}"
-        print(f"Error: {error_msg}")
-        raise HTTPException(status_code=500, detail=error_msg)
+    except HTTPException:
+        raise
     except FileNotFoundError as e:
         error_msg = f"Required tool not found: {str(e)}"
         print(f"Error: {error_msg}")
@@ -139,40 +725,45 @@ async def transcribe_video(file: UploadFile = File(...)):
         print(f"Error: {error_msg}")
         raise HTTPException(status_code=500, detail=error_msg)
     finally:
+        if inflight is not None:
+            INFLIGHT.pop(file_hash, None)
+            if not inflight.done():
+                # Failed or cancelled, let waiters retry rather than hang
+                inflight.set_exception(HTTPException(status_code=503, detail="Coalesced transcription failed, please retry"))
+                # Mark it retrieved so there's no warning when nobody was waiting
+                inflight.exception()
+
         # 6. Clean up only temporary files (keep cache files)
         cleanup_files = [temp_input_path]
-        # Only clean up temp audio if it's not the cached version
-        if temp_audio_path != cached_audio_path and temp_audio_path.startswith(TEMP_DIR):
-            cleanup_files.extend([temp_audio_path, f"{temp_audio_path}.txt"])
-        
-        for file_path in cleanup_files:
-            if os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                    print(f"Cleaned up temp file: {file_path}")
-                except Exception as e:
-                    print(f"Failed to clean up {file_path}: {e}")
+        # A partial cached WAV is left behind only if conversion failed
+        if partial_audio_path is not None:
+            cleanup_files.append(partial_audio_path)
+        # Uploads can be hundreds of MB, unlinking them can stall the event loop
+        try:
+            await asyncio.to_thread(remove_files, cleanup_files)
+            print(f"Cleaned up temp files for: {unique_id}")
+        except Exception as e:
+            print(f"Failed to clean up temp files for {unique_id}: {e}")
 
 @app.get("/")
 def read_root():
     return {
-        "service": "Whisper.cpp Transcription API", 
+        "service": "Whisper Transcription API",
         "status": "running",
         "version": "1.0.0",
         "endpoints": {
-            "POST /transcribe": "Upload audio/video file for transcription",
+            "POST /transcribe": "Upload audio/video file for transcription (optional X-Content-BLAKE3 header skips the upload read on cache hits)",
             "GET /health": "Health check endpoint"
         },
         "supported_formats": ["mp4", "mp3", "wav", "flac", "ogg"],
-        "whisper_model": os.path.basename(WHISPER_MODEL_PATH)
+        "whisper_model": WHISPER_MODEL
     }
 
 @app.get("/health")
 def health_check():
     """Health check endpoint for monitoring"""
     checks = {
-        "whisper_executable": os.path.exists(WHISPER_EXECUTABLE),
-        "whisper_model": os.path.exists(WHISPER_MODEL_PATH),
+        "whisper_model": getattr(app.state, "model", None) is not None,
         "temp_directory": os.path.exists(TEMP_DIR),
         "cache_directory": os.path.exists(CACHE_DIR)
     }
@@ -183,7 +774,8 @@ def health_check():
     return {
         "status": "healthy" if all_healthy else "unhealthy",
         "checks": checks,
-        "whisper_executable_path": WHISPER_EXECUTABLE,
-        "whisper_model_path": WHISPER_MODEL_PATH,
+        "whisper_model": WHISPER_MODEL,
+        "device": app.state.whisper_device,
+        "compute_type": get_compute_type(app.state.whisper_device),
         "cache_directory": CACHE_DIR
     }
\ No newline at end of file
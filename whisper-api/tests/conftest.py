@@ -0,0 +1,85 @@
+import io
+import os
+import time
+import wave
+from types import SimpleNamespace
+
+import numpy as np
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+def make_wav(samples: np.ndarray, extra_chunks: bytes = b"") -> bytes:
+    """A 16kHz mono s16le WAV, with optional chunks placed before the data chunk"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as w:
+        w.setnchannels(main.AUDIO_CHANNELS)
+        w.setsampwidth(2)
+        w.setframerate(main.AUDIO_SAMPLE_RATE)
+        w.writeframes(samples.astype("<i2").tobytes())
+    data = buffer.getvalue()
+    # wave writes RIFF header, fmt chunk, then data
+    fmt_end = 12 + 8 + int.from_bytes(data[16:20], "little")
+    body = data[:fmt_end] + extra_chunks + data[fmt_end:]
+    return body[:4] + (len(body) - 8).to_bytes(4, "little") + body[8:]
+
+
+def cache_audio(upload: bytes, samples: np.ndarray):
+    """Store samples as the cached WAV of an upload, so requests skip conversion"""
+    upload_path = os.path.join(main.TEMP_DIR, "upload")
+    with open(upload_path, "wb") as f:
+        f.write(upload)
+    file_hash = main.get_file_hash(upload_path)
+    os.remove(upload_path)
+    with open(os.path.join(main.CACHE_DIR, f"{file_hash}.wav"), "wb") as f:
+        f.write(make_wav(samples))
+
+
+class FakePipeline:
+    """Stands in for BatchedInferencePipeline, two segments per clip naming its length in samples
+
+    Each clip takes segment_delay seconds to decode.
+    """
+
+    segment_delay = 0
+
+    def __init__(self, model=None, silent=()):
+        self.silent = set(silent)
+        self.calls = []
+
+    def transcribe(self, audio, clip_timestamps, batch_size, **kwargs):
+        self.calls.append((len(clip_timestamps), batch_size))
+
+        def segments():
+            for i, clip in enumerate(clip_timestamps):
+                if i in self.silent:
+                    continue
+                time.sleep(self.segment_delay)
+                middle = (clip["start"] + clip["end"]) / 2
+                samples = round((clip["end"] - clip["start"]) * main.AUDIO_SAMPLE_RATE)
+                yield SimpleNamespace(text=f" c{i}", start=round(clip["start"], 3), end=round(middle, 3))
+                yield SimpleNamespace(text=f" {samples} ", start=round(middle, 3), end=round(clip["end"], 3))
+
+        return segments(), None
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """The app on fresh cache and temp directories, with a fake model"""
+    cache_dir = tmp_path / "cache"
+    for path in (tmp_path / "temp", cache_dir / "chunks"):
+        path.mkdir(parents=True)
+    monkeypatch.setattr(main, "TEMP_DIR", str(tmp_path / "temp"))
+    monkeypatch.setattr(main, "CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(main, "CHUNK_CACHE_DIR", str(cache_dir / "chunks"))
+    monkeypatch.setattr(main, "CACHED_HASHES", set())
+    monkeypatch.setattr(main, "CACHED_CHUNKS", set())
+    monkeypatch.setattr(main, "CACHE_LRU", main.CacheLRU(0))
+    monkeypatch.setattr(main, "resolve_whisper_device", lambda: "cpu")
+    monkeypatch.setattr(main, "load_whisper_model", lambda device: object())
+    monkeypatch.setattr(main, "BatchedInferencePipeline", FakePipeline)
+    with TestClient(main.app) as test_client:
+        yield test_client
@@ -0,0 +1,62 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import main
+
+
+def synthetic_speech(rng: np.random.Generator, seconds: float) -> np.ndarray:
+    """Noise bursts separated by pauses, quantized like decoded s16le PCM"""
+    parts = []
+    total = 0
+    while total < seconds * main.AUDIO_SAMPLE_RATE:
+        burst = rng.normal(0, 0.2, int(rng.uniform(0.5, 4) * main.AUDIO_SAMPLE_RATE))
+        pause = rng.normal(0, 0.001, int(rng.uniform(0.35, 1.2) * main.AUDIO_SAMPLE_RATE))
+        parts += [burst, pause]
+        total += len(burst) + len(pause)
+    audio = np.clip(np.concatenate(parts), -1, 32767 / 32768)
+    return (np.round(audio * 32768) / 32768).astype(np.float32)
+
+
+def chunk_hashes(audio: np.ndarray) -> list[str]:
+    return main.hash_chunks(main.split_on_silence(audio))
+
+
+def test_chunks_cover_audio_within_bounds():
+    audio = synthetic_speech(np.random.default_rng(0), 300)
+    chunks = main.split_on_silence(audio)
+    assert np.array_equal(np.concatenate(chunks), audio)
+    assert all(len(chunk) <= main.CHUNK_MAX_SECONDS * main.AUDIO_SAMPLE_RATE for chunk in chunks)
+
+
+@pytest.mark.parametrize("prefix_samples", [1, 799, 79793, 80000, 80480])
+def test_chunk_hashes_survive_prefix(prefix_samples):
+    rng = np.random.default_rng(1)
+    audio = synthetic_speech(rng, 300)
+    intro = synthetic_speech(rng, 10)[:prefix_samples]
+
+    original = chunk_hashes(audio)
+    edited = set(chunk_hashes(np.concatenate([intro, audio])))
+    # Only the chunks the new intro runs into can change
+    assert len(original) > 10
+    assert all(chunk_hash in edited for chunk_hash in original[2:])
+
+
+def test_cuts_do_not_depend_on_block_size(monkeypatch):
+    audio = synthetic_speech(np.random.default_rng(2), 300)
+    expected = chunk_hashes(audio)
+    monkeypatch.setattr(main, "CHUNK_ENERGY_BLOCK", 7919)
+    assert chunk_hashes(audio) == expected
+
+
+def test_memory_stays_bounded_on_long_audio():
+    audio = synthetic_speech(np.random.default_rng(3), 600)
+    tracemalloc.start()
+    try:
+        main.split_on_silence(audio)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # A few blocks of int64 window sums, far below one more copy of the audio
+    assert peak < audio.nbytes // 2
@@ -0,0 +1,43 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import main
+from conftest import FakePipeline, cache_audio
+
+
+def test_clips_are_batched_in_one_call_and_mapped_back():
+    audio = np.zeros(main.AUDIO_SAMPLE_RATE * 90, dtype=np.float32)
+    clips = [(0, 160_003), (160_003, 400_000), (800_000, 1_280_000), (1_280_000, 1_440_000)]
+    pipeline = FakePipeline(silent={2})
+
+    texts = main.transcribe_job(pipeline, audio, clips, time.monotonic() + 60)
+
+    assert pipeline.calls == [(4, main.WHISPER_BATCH_SIZE)]
+    assert texts == ["c0 160003", "c1 239997", "", "c3 160000"]
+
+
+def post_cached(client, uploads):
+    """Post uploads whose audio is cached, all at once"""
+    for upload in uploads:
+        cache_audio(upload, np.zeros(48000, dtype=np.int16))
+    with ThreadPoolExecutor(len(uploads)) as pool:
+        return list(pool.map(
+            lambda upload: client.post("/transcribe", files={"file": ("clip.mp4", upload, "video/mp4")}).status_code,
+            uploads,
+        ))
+
+
+def test_queue_wait_does_not_count_against_timeout(client, monkeypatch):
+    monkeypatch.setattr(main, "WHISPER_TIMEOUT_MIN", 1)
+    monkeypatch.setattr(main, "WHISPER_TIMEOUT_PER_SECOND", 0)
+    monkeypatch.setattr(FakePipeline, "segment_delay", 0.6)
+    assert post_cached(client, [b"first", b"second", b"third"]) == [200, 200, 200]
+
+
+def test_stuck_transcription_times_out(client, monkeypatch):
+    monkeypatch.setattr(main, "WHISPER_TIMEOUT_MIN", 0.5)
+    monkeypatch.setattr(main, "WHISPER_TIMEOUT_PER_SECOND", 0)
+    monkeypatch.setattr(FakePipeline, "segment_delay", 0.6)
+    assert post_cached(client, [b"slow"]) == [504]
@@ -0,0 +1,49 @@
+import io
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import main
+from conftest import cache_audio, make_wav
+
+
+def test_reads_data_chunk_like_pcm_to_array():
+    samples = np.random.default_rng(0).integers(-32768, 32767, 16000, dtype=np.int16)
+    audio = main.read_wav_samples(io.BytesIO(make_wav(samples)))
+    assert np.array_equal(audio, main.pcm_to_array(samples.tobytes()))
+
+
+def test_skips_padded_chunks_before_data():
+    samples = np.arange(-500, 500, dtype=np.int16)
+    # An odd-sized LIST chunk is followed by one byte of padding
+    extra = b"LIST" + (5).to_bytes(4, "little") + b"INFOx" + b"\0"
+    audio = main.read_wav_samples(io.BytesIO(make_wav(samples, extra)))
+    assert np.array_equal(audio, main.pcm_to_array(samples.tobytes()))
+
+
+def test_rejects_non_wav():
+    with pytest.raises(ValueError):
+        main.read_wav_samples(io.BytesIO(b"\0\0\0\x18ftypmp42"))
+
+
+def test_cached_wav_hit_is_transcribed(client):
+    upload = b"a video whose audio is already cached"
+    cache_audio(upload, np.zeros(48000, dtype=np.int16))
+
+    response = client.post("/transcribe", files={"file": ("clip.mp4", upload, "video/mp4")})
+
+    assert response.status_code == 200
+    assert response.json() == {"caption": "c0 48000", "cached": False}
+    assert os.listdir(main.TEMP_DIR) == []
+
+
+@pytest.mark.skipif(shutil.which("ffprobe") is None, reason="needs ffprobe")
+def test_whisper_ready_upload_skips_conversion(client):
+    upload = make_wav(np.ones(32000, dtype=np.int16))
+
+    response = client.post("/transcribe", files={"file": ("clip.wav", upload, "audio/wav")})
+
+    assert response.status_code == 200
+    assert response.json() == {"caption": "c0 32000", "cached": False}